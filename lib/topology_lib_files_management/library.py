@@ -17,6 +17,75 @@ import os
 import re
 import requests
 import codecs
+import binascii
+import zlib
+import hashlib
+import tempfile
+import threading
+import itertools
+from collections import OrderedDict, namedtuple
+
+from six.moves import queue, shlex_quote
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+# Files smaller than this are not worth splitting in several HTTP ranges
+_RANGE_MIN_SIZE = 1024 * 1024
+
+# Maximum size of every HTTP range, smaller ranges are complete sooner and
+# can be used while the rest of the file is still being downloaded
+_RANGE_SIZE = 1024 * 1024
+
+# Maximum number of chunks buffered between the download and the upload
+_PIPELINE_DEPTH = 16
+
+# Compression is only considered for payloads at least this big, and it
+# is estimated on a sample of this size taken from the payload start
+_COMPRESS_MIN_SIZE = 1024
+_COMPRESS_SAMPLE_SIZE = 65536
+
+# A codec is only used when it shrinks the sample below this fraction of
+# the best size so far (no compression or a cheaper codec)
+_COMPRESS_MAX_RATIO = 0.9
+
+# Printed after a remote command to recover its exit status
+_STATUS_MARKER = '__FILES_MANAGEMENT_RC='
+
+# Printed before the new content of every file polled by RemoteFollower
+_FOLLOW_MARKER = '__FILES_MANAGEMENT_FOLLOW'
+
+# Printed around the output of every step of a FilePlan
+_STEP_MARKER = '__FILES_MANAGEMENT_STEP'
+
+# Conservative bound for the length of a command line sent to a node
+_MAX_CMD_LEN = 32768
+
+# Printed with the exit status of every file copied by scp_many
+_SCP_MARKER = '__FILES_MANAGEMENT_SCP'
+
+# Maximum number of origins copied by a single scp_many invocation
+_SCP_BATCH = 32
+
+# scp options, in the order they are added to the command line
+_SCP_OPTIONS = [('c', '-c'), ('i', '-i'), ('p', '-p'), ('r', '-r'),
+                ('v', '-v'), ('bash', '-B'), ('q', '-q'), ('compress', '-C'),
+                ('ssh_file', '-S'), ('port', '-P'), ('program', '-S'),
+                ('o', '-o'), ('four', '-4'), ('six', '-6')]
+
+# Digest length in hex characters of the algorithms with a *sum tool
+_CHECKSUM_LENGTHS = {'md5': 32, 'sha1': 40, 'sha224': 56, 'sha256': 64,
+                     'sha384': 96, 'sha512': 128}
+
+# Fallback used on nodes without the *sum tool, prints the same format
+_CHECKSUM_SCRIPT = (
+    'import hashlib, os, sys; [sys.stdout.write(hashlib.new(sys.argv[1], '
+    'open(p, "rb").read()).hexdigest() + "  " + p + "\\n") '
+    'for p in sys.argv[2:] if os.path.isfile(p)]'
+)
 
 
 def scp_command(enode, origin_file, destination_file, remote_user=None,
@@ -68,10 +137,7 @@ def scp_command(enode, origin_file, destination_file, remote_user=None,
 
     remote_arg = ['remote_user', 'remote_ip', 'remote_file']
 
-    optional_arg = {'c': '-c', 'i': '-i', 'p': '-p', 'r': '-r', 'v': '-v',
-                    'bash': '-B', 'q': '-q', 'compress': '-C',
-                    'ssh_file': '-S', 'port': '-P', 'program': '-S',
-                    'o': '-o', 'four': '-4', 'six': '-6'}
+    optional_arg = dict(_SCP_OPTIONS)
 
     options = ''
     command = origin_file + " " + destination_file
@@ -123,6 +189,139 @@ def scp_command(enode, origin_file, destination_file, remote_user=None,
         assert scp_response is ''
 
 
+class ScpResult(namedtuple('ScpResult',
+                           ['origin', 'destination', 'status'])):
+    """
+    Exit status of the copy of a file by scp_many
+    """
+    __slots__ = ()
+
+
+def scp_many(enode, jobs, remote_user=None, remote_ip=None,
+             remote_side=None, remote_pass=None, max_per_remote=2, c=None,
+             i=None, p=False, r=False, v=False, bash=True, q=True,
+             compress=False, ssh_file=None, port=None, program=None, o=None,
+             four=False, six=False, shell='bash'):
+    """
+    This function will execute several SCP copies concurrently on the enode
+    IMPORTANT: It is implemented to work from bash of the SW
+
+    Jobs are grouped by remote host. Jobs of a group that share a
+    destination directory (ending with /) are copied with a single scp
+    invocation, retried one by one when it fails so every file gets its own
+    status. Every remote host gets up to max_per_remote background jobs on
+    the node and all the hosts are served at the same time, everything with
+    a single command.
+
+    Copies can not answer interactive prompts: authentication must be done
+    with keys, or with remote_pass when sshpass is installed on the node.
+
+    :param list jobs: (origin, destination) or (origin, destination,
+    remote_ip) tuples, remote_ip defaults to the remote_ip argument.
+    :param int max_per_remote: Maximum number of concurrent scp processes
+    for every remote host; Default: 2.
+    :param bool bash: -B: Selects batch mode, ignored when remote_pass is
+    given; Default: True.
+    :param bool q: Disables the progress meter; Default: True.
+    See scp_command for the rest of the parameters.
+    :returns: The exit status of every job, in the same order as jobs.
+    :rtype: list of ScpResult.
+    """
+    arguments = locals()
+    options = ''
+    for key, flag in _SCP_OPTIONS:
+        value = arguments[key]
+        if key == 'bash' and remote_pass is not None:
+            # Batch mode disables the password authentication sshpass uses
+            continue
+        if value is True:
+            options = '{0}{1} '.format(options, flag)
+        elif value is not False and value is not None:
+            options = '{0}{1} {2} '.format(
+                options, flag, shlex_quote(str(value)))
+    scp_cmd = 'scp {0}'.format(options)
+    if remote_pass is not None:
+        scp_cmd = 'SSHPASS={0} sshpass -e {1}'.format(
+            shlex_quote(remote_pass), scp_cmd)
+
+    def remote(host, path):
+        if remote_user is not None:
+            host = '{0}@{1}'.format(remote_user, host)
+        return '{0}:{1}'.format(host, shlex_quote(path))
+
+    # Group the invocations by remote host
+    groups = OrderedDict()
+    for index, job in enumerate(jobs):
+        origin, destination = job[:2]
+        host = job[2] if len(job) > 2 else remote_ip
+        if host is None:
+            origin, destination = shlex_quote(origin), shlex_quote(destination)
+        elif remote_side == 'origin':
+            origin, destination = remote(host, origin), \
+                shlex_quote(destination)
+        else:
+            origin, destination = shlex_quote(origin), \
+                remote(host, destination)
+        invocations = groups.setdefault(host, [])
+        merged = [invocation for invocation in invocations
+                  if job[1].endswith('/') and invocation[1] == destination
+                  and len(invocation[0]) < _SCP_BATCH]
+        if merged:
+            merged[0][0].append((index, origin))
+        else:
+            invocations.append(([(index, origin)], destination))
+
+    def invocation_cmd(origins, destination):
+        single = '{0}{1} {2} >/dev/null 2>&1; echo "{3} {4} $?"'
+        if len(origins) == 1:
+            index, origin = origins[0]
+            return single.format(scp_cmd, origin, destination, _SCP_MARKER,
+                                 index)
+        return 'if {0}{1} {2} >/dev/null 2>&1; then {3}; else {4}; fi'.format(
+            scp_cmd, ' '.join(origin for _, origin in origins), destination,
+            '; '.join('echo "{0} {1} 0"'.format(_SCP_MARKER, index)
+                      for index, _ in origins),
+            '; '.join(single.format(scp_cmd, origin, destination,
+                                    _SCP_MARKER, index)
+                      for index, origin in origins)
+        )
+
+    lanes = []
+    for invocations in groups.values():
+        concurrency = max(1, min(max_per_remote, len(invocations)))
+        group_lanes = [[] for _ in range(concurrency)]
+        for number, invocation in enumerate(invocations):
+            group_lanes[number % len(group_lanes)].append(
+                invocation_cmd(*invocation))
+        lanes.extend(group_lanes)
+    if not lanes:
+        return []
+
+    # A subshell keeps the background jobs out of the shell's job control
+    scp_many_cmd = '( {0} wait )'.format(
+        ' '.join('( {0} ) &'.format('; '.join(lane)) for lane in lanes))
+    output = enode(scp_many_cmd, shell=shell)
+
+    statuses = dict(
+        (int(index), int(status)) for index, status in re.findall(
+            r'{0} (\d+) (\d+)'.format(_SCP_MARKER), output)
+    )
+    return [ScpResult(job[0], job[1], statuses.get(index))
+            for index, job in enumerate(jobs)]
+
+
+def _rm_cmd(file_to_rm, d=False, f=True, i=False, r=False, v=False):
+    """ Builds the rm command line used by rm_command and FilePlan """
+    optional_arg = [('d', d), ('f', f), ('i', i), ('r', r), ('v', v)]
+
+    options = ''
+    for key, value in optional_arg:
+        if value is True:
+            options = '{0}-{1} '.format(options, key)
+
+    return 'rm {0}{1}'.format(options, file_to_rm)
+
+
 def rm_command(enode, file_to_rm, d=False, f=True, i=False, r=False, v=False,
                shell='bash'):
     """
@@ -141,18 +340,7 @@ def rm_command(enode, file_to_rm, d=False, f=True, i=False, r=False, v=False,
     :param bool v: --verbose; explain what is being done; Default: False.
     """
 
-    arguments = locals()
-    required_arg = ['file_to_rm']
-    optional_arg = {'d': '-d', 'f': '-f', 'i': '-i', 'r': '-r', 'v': '-v'}
-
-    command = file_to_rm
-    options = ''
-
-    for key, value in list(arguments.items()):
-        if value is True:
-            options = '{0}{1} '.format(options, optional_arg.get(key))
-
-    rm_cmd = 'rm {0}{1}'.format(options, command)
+    rm_cmd = _rm_cmd(file_to_rm, d=d, f=f, i=i, r=r, v=v)
     rm_response = enode(rm_cmd, shell=shell)
     assert rm_response is ''
 
@@ -208,26 +396,74 @@ def file_exists(enode, file_name, path):
     assert file_name in file_exists, 'file does not exists'
 
 
-def echo_filecopy(enode, source_file_path, destn_file_path):
+def echo_filecopy(enode, source_file_path, destn_file_path, codec=None,
+                  chunk_size=2048):
     """
     This function will copy the source file to enode destination file path
     using enode rapid fire() with echo command.
 
+    When a codec is given the file is instead written in binary safe
+    chunks with printf, optionally compressed and decompressed on the node
+    with its gzip or xz tool.
+
+    Unlike transfer_file, the codec defaults to None to keep the historic
+    echo based copy existing callers rely on: it is not an exact copy,
+    echo appends an extra newline to every line and the shell expands the
+    content inside the double quotes.
+
     :param str source_file_path: This is the file, or path or the file to be
     copied
     :param str destn_file_path: This is the file, or path for the destination
     on enode
+    :param str codec: Compression used on the wire. Options: none|gzip|xz|
+    auto. auto compresses a sample of the file and only compresses it when
+    it pays off; Default: None, copies the file line by line with echo.
+    :param int chunk_size: Number of bytes written on every command when a
+    codec is given.
+    :returns: The sizes, codec and compression ratio, codec is 'none' on
+    the echo based copy.
+    :rtype: TransferResult.
     """
     assert len(source_file_path) > 0, "empty source file path"
     # TODO add a check for source file existance
     assert os.path.isfile(source_file_path), "source file doesn't exists"
     assert len(destn_file_path) > 0, "empty destination file path"
-    file_remove_command = "rm " + destn_file_path
-    enode(file_remove_command, shell="bash")
-    with open(source_file_path, "r") as source_file:
-        for line in source_file:
-            enode('echo "' + line + '" >> ' + destn_file_path,
-                  shell="bash")
+    if codec is None:
+        file_remove_command = "rm " + destn_file_path
+        enode(file_remove_command, shell="bash")
+        with open(source_file_path, "r") as source_file:
+            for line in source_file:
+                enode('echo "' + line + '" >> ' + destn_file_path,
+                      shell="bash")
+        size = [os.path.getsize(source_file_path)]
+        return _transfer_result(destn_file_path, 'none', size, size)
+
+    tools = [candidate.tool for candidate in _CODECS.values()
+             if candidate.tool is not None and
+             codec in ('auto', candidate.name)]
+    tools_check_command = "for tool in {}; do command -v $tool " \
+                          ">/dev/null 2>&1 && echo $tool; done" \
+                          "".format(' '.join(tools))
+    available = enode(tools_check_command, shell="bash").split() \
+        if tools else []
+    candidates = [candidate.name for candidate in _CODECS.values()
+                  if candidate.tool in available]
+
+    chunks = _iter_file_chunks(source_file_path)
+    codec, chunks, size, sent = _encode_stream(chunks, codec, candidates)
+    destn_file = shlex_quote(destn_file_path)
+    written_file = destn_file
+    if codec != 'none':
+        written_file = shlex_quote(destn_file_path + '.' + codec)
+    _printf_write(enode, chunks, written_file, chunk_size)
+    if codec != 'none':
+        decompress_command = '{tool} -dc {src} > {dst} && rm -f {src}' \
+                             ''.format(tool=_CODECS[codec].tool,
+                                       src=written_file, dst=destn_file)
+        output, status = _bash_status(enode, decompress_command)
+        assert status == 0, "Unable to decompress {}: {}".format(
+            destn_file_path, output)
+    return _transfer_result(destn_file_path, codec, size, sent)
 
 
 def create_filebkup(enode, destn_file_path):
@@ -268,33 +504,425 @@ def restore_filebkup(enode, destn_file_path):
     enode("rm -f " + backup_destn_file_path, shell="bash")
 
 
-def _get_file_contents(file_orig):
+def _thread_map(func, items, workers):
     """
-    Returns the contents of a file hosted on local or remote location
+    Runs func over every item using a bounded pool of threads
 
-    :param str file_orig: File to get content.
-    :returns: The content of the file.
-    :rtype: str.
+    :param func: Callable that receives a single item.
+    :param items: Iterable with the items to process.
+    :param int workers: Maximum number of concurrent threads.
+    :returns: The results in the same order as the items.
+    :rtype: list.
     """
-    # TODO: Add support for other remotes, e.g. ftp://
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    pending = queue.Queue()
+    for index, item in enumerate(items):
+        pending.put((index, item))
+
+    def worker():
+        while not errors:
+            try:
+                index, item = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(1, min(workers, len(items))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def _hash_file(path, algo='sha256', chunk_size=1024 * 1024):
+    """ Returns the hex digest of a local file """
+    digest = hashlib.new(algo)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _check_http_status(file_orig, result):
+    """ Asserts the HTTP response of a file request is usable """
+    assert result.status_code != requests.codes.not_found, \
+        "File not found: {}".format(file_orig)
+    assert result.status_code in (requests.codes.ok,
+                                  requests.codes.partial_content), \
+        "Unable to get file: {} Error code: {}" \
+        "".format(file_orig,
+                  result.status_code)
+
+
+def _http_ranges(file_orig, connections):
+    """
+    Checks whether a file can be downloaded in parallel byte ranges
+
+    :param str file_orig: URL of the file.
+    :param int connections: Maximum number of parallel HTTP connections.
+    :returns: The size of the file and the validator that pins the ranges
+    to the same version of the file, None when ranges can not be used.
+    :rtype: tuple.
+    """
+    if connections <= 1:
+        return None
+    head = requests.head(file_orig, allow_redirects=True)
+    headers = head.headers
+    # Servers that reject HEAD or encode the content on the fly get a
+    # single stream, Content-Length would not match the ranges
+    if not head.ok or 'Content-Encoding' in headers or \
+            headers.get('Accept-Ranges', '').lower() != 'bytes':
+        return None
+    try:
+        size = int(headers.get('Content-Length'))
+    except (TypeError, ValueError):
+        return None
+    if size < _RANGE_MIN_SIZE:
+        return None
+    return size, headers.get('ETag') or headers.get('Last-Modified')
+
+
+def _iter_http_ranges(file_orig, size, validator, connections=4,
+                      chunk_size=65536):
+    """
+    Yields a HTTP file downloaded with several parallel Range requests
+
+    The file is split in ranges of at most _RANGE_SIZE bytes fetched in
+    order by a pool of threads straight into a preallocated temporary
+    file. Every range is yielded as soon as it and all the previous ones
+    are complete, so the caller can start using the beginning of the file
+    while the rest is still being downloaded.
+
+    :param str file_orig: URL of the file to download.
+    :param int size: Size of the file.
+    :param str validator: ETag or Last-Modified sent with If-Range.
+    :param int connections: Maximum number of parallel HTTP connections.
+    :param int chunk_size: Maximum size of every yielded chunk.
+    :returns: Generator with the content of the file.
+    :rtype: generator of bytes.
+    """
+    range_size = min(_RANGE_SIZE, -(-size // connections))
+    ranges = [(start, min(start + range_size, size) - 1)
+              for start in range(0, size, range_size)]
+    completed = queue.Queue()
+    stop = threading.Event()
+    fd, file_tmp = tempfile.mkstemp()
+    os.close(fd)
+
+    def fetch(file_range):
+        if stop.is_set():
+            return
+        start, end = file_range
+        range_headers = {'Range': 'bytes={}-{}'.format(start, end)}
+        if validator:
+            range_headers['If-Range'] = validator
+        result = requests.get(file_orig, headers=range_headers, stream=True)
+        _check_http_status(file_orig, result)
+        assert result.status_code == requests.codes.partial_content, \
+            "Server ignored range {}-{} of {}".format(start, end, file_orig)
+        written = 0
+        with open(file_tmp, 'r+b') as dst:
+            dst.seek(start)
+            for chunk in result.iter_content(chunk_size):
+                dst.write(chunk)
+                written += len(chunk)
+        assert written == end - start + 1, \
+            "Incomplete range {}-{} of {}".format(start, end, file_orig)
+        completed.put((file_range, None))
+
+    def download():
+        try:
+            _thread_map(fetch, ranges, connections)
+        except Exception as e:
+            completed.put((None, e))
+
+    try:
+        # Preallocate the file so every range can be written in place
+        with open(file_tmp, 'wb') as dst:
+            dst.truncate(size)
+        downloader = threading.Thread(target=download)
+        downloader.daemon = True
+        downloader.start()
+        finished = set()
+        # Unbuffered, a read ahead would return ranges not downloaded yet
+        with open(file_tmp, 'rb', 0) as src:
+            for start, end in ranges:
+                while (start, end) not in finished:
+                    file_range, error = completed.get()
+                    if error is not None:
+                        raise error
+                    finished.add(file_range)
+                src.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = src.read(min(chunk_size, remaining))
+                    assert chunk, "Unexpected size for {}".format(file_orig)
+                    remaining -= len(chunk)
+                    yield chunk
+    finally:
+        stop.set()
+        os.remove(file_tmp)
+
+
+def _iter_file_source(file_orig, chunk_size=65536, connections=1):
+    """ Yields the raw contents of a local file or a HTTP URL """
     is_remote = re.compile("http[s]?://")
     if is_remote.match(file_orig):
-        result = requests.get(file_orig)
-        assert result.status_code is not requests.codes.not_found, \
-            "File not found: {}".format(file_orig)
-        assert result.status_code is requests.codes.ok, \
-            "Unable to get file: {} Error code: {}" \
-            "".format(file_orig,
-                      result.status_code)
-        file_contents = result.text
-    else:
+        ranges = _http_ranges(file_orig, connections)
+        if ranges is not None:
+            size, validator = ranges
+            for chunk in _iter_http_ranges(file_orig, size, validator,
+                                           connections, chunk_size):
+                yield chunk
+            return
+        result = requests.get(file_orig, stream=True)
+        _check_http_status(file_orig, result)
+        for chunk in result.iter_content(chunk_size):
+            if chunk:
+                yield chunk
+        return
+    try:
+        file = open(file_orig, 'rb')
+    except Exception as e:
+        assert False, "Unable to get file {}: {}".format(file_orig, e)
+    with file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            yield chunk
+
+
+def _iter_file_chunks(file_orig, chunk_size=65536, connections=1,
+                      checksum=None, checksum_algo='sha256'):
+    """
+    Yields the contents of a file hosted on local or remote location
+
+    :param str file_orig: File to get content.
+    :param int chunk_size: Maximum size of every yielded chunk.
+    :param int connections: Number of parallel HTTP range requests to use
+    for remote files, 1 streams the response as it arrives.
+    :param str checksum: Expected hex digest of the file, verified once
+    the last chunk has been yielded.
+    :param str checksum_algo: hashlib algorithm used for the checksum.
+    :returns: Generator with the content of the file.
+    :rtype: generator of bytes.
+    """
+    digest = hashlib.new(checksum_algo) if checksum is not None else None
+    for chunk in _iter_file_source(file_orig, chunk_size, connections):
+        if digest is not None:
+            digest.update(chunk)
+        yield chunk
+    if digest is not None:
+        assert digest.hexdigest() == checksum.lower(), \
+            "Checksum mismatch for {}".format(file_orig)
+
+
+class _Codec(namedtuple('_Codec', ['name', 'compressor', 'module',
+                                   'decompressor', 'flush', 'tool'])):
+    """
+    Compression codec usable on transfers
+
+    The compressor is a callable returning a local streaming compressor,
+    module and decompressor are the remote Python module and expression
+    creating its streaming decompressor, flush tells whether that
+    decompressor must be flushed and tool is the remote command line
+    decompressor, if any.
+    """
+    __slots__ = ()
+
+
+# Codecs in order of preference, cheaper ones first
+_CODECS = OrderedDict((codec.name, codec) for codec in (
+    _Codec('zlib', lambda: zlib.compressobj(6), 'zlib',
+           'zlib.decompressobj()', True, None),
+    _Codec('gzip',
+           lambda: zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+           'zlib', 'zlib.decompressobj(16 + zlib.MAX_WBITS)', True, 'gzip'),
+    _Codec('xz', lambda: lzma.LZMACompressor(), 'lzma',
+           'lzma.LZMADecompressor()', False, 'xz'),
+) if codec.name != 'xz' or lzma is not None)
+
+
+class TransferResult(namedtuple('TransferResult',
+                                ['path', 'size', 'sent', 'codec', 'ratio'])):
+    """
+    Result of a file transfer to a node
+
+    Holds the remote path, the size of the file, the bytes sent after
+    compression, the codec used and the compression ratio (size / sent).
+    """
+    __slots__ = ()
+
+
+def _choose_codec(sample, candidates):
+    """
+    Picks the codec for a payload compressing a sample of its start
+
+    There is no CPU cost model: the consoles these transfers go through
+    are much slower than any codec, so the CPU cost is approximated with a
+    fixed margin. Candidates are tried cheapest first and one is only
+    picked when it shrinks the sample below _COMPRESS_MAX_RATIO of the
+    best size so far, i.e. a slower codec must save another 10% over a
+    cheaper one. gzip is the same deflate stream as zlib with a larger
+    header, so it is only picked when zlib is not a candidate, as on the
+    shell based transfers that decompress with the node's gzip tool.
+
+    :param bytes sample: Start of the payload.
+    :param list candidates: Names of the codecs supported by both ends.
+    :returns: The name of the codec to use, 'none' for no compression.
+    :rtype: str.
+    """
+    best, best_size = 'none', len(sample)
+    if best_size < _COMPRESS_MIN_SIZE:
+        return best
+    for name in candidates:
+        compressor = _CODECS[name].compressor()
+        size = len(compressor.compress(sample) + compressor.flush())
+        if size < best_size * _COMPRESS_MAX_RATIO:
+            best, best_size = name, size
+    return best
+
+
+def _peek(chunks, size):
+    """
+    Reads the first size bytes of a stream of chunks without consuming it
+
+    :returns: The first bytes and an iterator over the whole stream.
+    :rtype: tuple.
+    """
+    chunks = iter(chunks)
+    head = []
+    length = 0
+    for chunk in chunks:
+        head.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            break
+    return b''.join(head)[:size], itertools.chain(head, chunks)
+
+
+def _iter_counted(chunks, counter):
+    """ Adds the length of every chunk to counter[0] as they go through """
+    for chunk in chunks:
+        counter[0] += len(chunk)
+        yield chunk
+
+
+def _iter_compressed(chunks, codec):
+    """ Compresses a stream of bytes chunks with the given codec """
+    compressor = _CODECS[codec].compressor()
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def _encode_stream(chunks, codec, candidates):
+    """
+    Compresses a stream of chunks with the codec requested for a transfer
+
+    :param chunks: Iterable with the payload.
+    :param str codec: Codec name, 'auto' samples the payload to pick one
+    of the candidates.
+    :param list candidates: Names of the codecs supported by both ends.
+    :returns: The codec used, the stream to send and the counters of the
+    original and sent bytes.
+    :rtype: tuple.
+    """
+    assert codec == 'none' or codec == 'auto' or codec in candidates, \
+        "codec {} not supported".format(codec)
+    if codec == 'auto':
+        sample, chunks = _peek(chunks, _COMPRESS_SAMPLE_SIZE)
+        codec = _choose_codec(sample, candidates)
+    size = [0]
+    sent = [0]
+    chunks = _iter_counted(chunks, size)
+    if codec != 'none':
+        chunks = _iter_compressed(chunks, codec)
+    return codec, _iter_counted(chunks, sent), size, sent
+
+
+def _transfer_result(path, codec, size, sent):
+    """ Builds the TransferResult of a transfer from its counters """
+    ratio = float(size[0]) / sent[0] if sent[0] else 1.0
+    return TransferResult(path, size[0], sent[0], codec, ratio)
+
+
+def _iter_rechunked(chunks, chunk_size):
+    """ Regroups a stream of bytes chunks in blocks of chunk_size bytes """
+    pending = b''
+    for chunk in chunks:
+        pending += chunk
+        offset = 0
+        while len(pending) - offset >= chunk_size:
+            yield pending[offset:offset + chunk_size]
+            offset += chunk_size
+        pending = pending[offset:]
+    if pending:
+        yield pending
+
+
+def _iter_background(iterator, depth=_PIPELINE_DEPTH):
+    """
+    Consumes an iterator on a separate thread through a bounded queue
+
+    This lets the producer (e.g. a download) overlap with whatever the
+    caller does with every item (e.g. an upload), while at most depth
+    items are held in memory.
+
+    :param iterator: Iterable to consume in the background.
+    :param int depth: Maximum number of items buffered.
+    :returns: Generator with the items of the iterator.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
         try:
-            file = open(file_orig)
-            file_contents = file.read()
-            file.close()
+            for item in iterator:
+                if not put((item, None)):
+                    # Let generators release their resources right away
+                    close = getattr(iterator, 'close', None)
+                    if close is not None:
+                        close()
+                    return
         except Exception as e:
-            assert False, "Unable to get file {}: {}".format(file_orig, e)
-    return file_contents
+            put((done, e))
+        else:
+            put((done, None))
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
 
 
 def _python_exec(shell, cmd):
@@ -315,38 +943,831 @@ def exists(enode, file):
     return "stat: cannot stat" not in res
 
 
-def transfer_file(enode, name, file_orig, dst_path="/tmp"):
+def transfer_file(enode, name, file_orig, dst_path="/tmp", connections=1,
+                  codec='auto', chunk_size=4096, checksum=None):
     """
-    Transfer a remote or local text file using remote's Python
+    Transfer a remote or local file using remote's Python
 
     The node must support Python with the "codecs" package
     The codecs package is used to transfer the file using hex format
     This is handy when transferring text files that may have special chars
     that are not properly handled with echo or other tools.
 
+    The file is streamed: it is read in chunks, optionally compressed,
+    hex encoded and written to the remote file one chunk at a time, while
+    the rest of the file is still being downloaded. With several
+    connections the download and the upload overlap range by range: a
+    range is sent once it and all the previous ones are downloaded.
+
     :param name: the name to give the file after it is copied
     :param file_orig: URL to fetch the file from (including file name)
     :param dst_path: final location where to put the file in remote node
+    :param connections: number of parallel HTTP connections used to fetch
+    large files from servers that support byte ranges
+    :param codec: compression used on the wire, the remote's Python
+    decompresses the chunks as they arrive. Options: none|zlib|gzip|xz|auto.
+    auto compresses a sample of the file and only compresses it when it
+    pays off; Default: auto.
+    :param chunk_size: number of bytes sent to the node on every command
+    :param checksum: expected sha256 hex digest of the file. It is verified
+    once the whole file was read, so a mismatch is reported after the
+    remote file was written
+    :returns: the remote path, sizes, codec and compression ratio
+    :rtype: TransferResult
     """
-    file_contents = _get_file_contents(file_orig)
-    # Encoding the file makes it easy to handle special chars
-    encoded = codecs.encode(file_contents.encode(), "hex").decode()
     remote_file = "{dst_path}/{name}".format(**locals())
     # From this point onwards, use remote's Python
     shell = enode.get_shell("bash")
     _python_exec(shell, "python")
-    # Store the decoded content on a remote's Python variable
-    _python_exec(shell, "import codecs")
-    _python_exec(shell, "decoded = codecs.decode('{encoded}', 'hex').decode()"
-                        "".format(**locals()))
-    # Write the decoded contents to file
-    _python_exec(shell, "file = open('{remote_file}', 'w')".format(**locals()))
-    _python_exec(shell, "file.write(decoded)")
-    _python_exec(shell, "file.close()")
-    shell.send_command("exit()")
+    try:
+        _python_exec(shell, "import codecs")
+        candidates = []
+        for candidate in _CODECS.values():
+            if codec not in ('auto', candidate.name):
+                continue
+            _python_exec(shell, "import {}".format(candidate.module))
+            if 'Error' not in shell.get_response():
+                candidates.append(candidate.name)
+
+        chunks = _iter_file_chunks(file_orig, connections=connections,
+                                   checksum=checksum)
+        codec, chunks, size, sent = _encode_stream(chunks, codec, candidates)
+        chunks = _iter_rechunked(chunks, chunk_size)
+        # Encoding the file makes it easy to handle special chars
+        encoded = (codecs.encode(chunk, "hex").decode() for chunk in chunks)
+
+        write = "file.write(codecs.decode('{}', 'hex'))"
+        if codec != 'none':
+            _python_exec(shell, "decompressor = {}".format(
+                _CODECS[codec].decompressor))
+            write = "file.write(decompressor.decompress(" \
+                    "codecs.decode('{}', 'hex')))"
+        # Write the decoded contents to file as they arrive
+        _python_exec(shell, "file = open('{remote_file}', 'wb')"
+                            "".format(**locals()))
+        try:
+            for chunk in _iter_background(encoded):
+                _python_exec(shell, write.format(chunk))
+            if codec != 'none' and _CODECS[codec].flush:
+                _python_exec(shell, "file.write(decompressor.flush())")
+        finally:
+            _python_exec(shell, "file.close()")
+    finally:
+        shell.send_command("exit()")
+    return _transfer_result(remote_file, codec, size, sent)
+
+
+def _bash_status(enode, cmd, shell='bash'):
+    """
+    Runs a command on the enode and returns its output and exit status
+
+    :param str cmd: Command to run.
+    :returns: The output of the command and its exit status.
+    :rtype: tuple.
+    """
+    response = enode('{} ; echo "{}$?"'.format(cmd, _STATUS_MARKER),
+                     shell=shell)
+    output, _, status = response.rpartition(_STATUS_MARKER)
+    for newline in ('\r\n', '\n'):
+        if output.endswith(newline):
+            output = output[:-len(newline)]
+            break
+    return output, int(status.strip())
+
+
+def _decode_od(output):
+    """ Converts the output of od -An -v -tx1 back to bytes """
+    return binascii.unhexlify(''.join(output.split()))
+
+
+def read_remote(enode, path, offset=0, length=None, chunk_size=65536,
+                shell='bash'):
+    """
+    Reads a byte window of a remote file without dumping the whole file
+
+    Only the requested window crosses the shell, hex encoded with od so
+    binary files are supported. Windows larger than chunk_size are read
+    with several commands, one for every yielded chunk.
+
+    :param str path: Path of the file on the enode.
+    :param int offset: Position of the first byte to read.
+    :param int length: Number of bytes to read, None reads until the end
+    of the file.
+    :param int chunk_size: Maximum number of bytes read on every command.
+    :returns: Generator with the contents of the window.
+    :rtype: generator of bytes.
+    """
+    assert offset >= 0, "negative offset"
+    remaining = length
+    while remaining is None or remaining > 0:
+        size = chunk_size if remaining is None else min(chunk_size,
+                                                        remaining)
+        read_cmd = "test -r {path} && tail -c +{start} {path} 2>/dev/null" \
+                   " | head -c {size} | od -An -v -tx1" \
+                   "".format(path=shlex_quote(path), start=offset + 1,
+                             size=size)
+        output, status = _bash_status(enode, read_cmd, shell=shell)
+        assert status == 0, "Unable to read remote file {}".format(path)
+        chunk = _decode_od(output)
+        if chunk:
+            yield chunk
+        if len(chunk) < size:
+            return
+        offset += len(chunk)
+        if remaining is not None:
+            remaining -= len(chunk)
+
+
+def tail_remote(enode, path, lines=10, shell='bash'):
+    """
+    Reads the last lines of a remote file
+
+    :param str path: Path of the file on the enode.
+    :param int lines: Number of lines to read.
+    :returns: Iterator over the lines, without line terminators.
+    :rtype: iterator of str.
+    """
+    tail_cmd = "test -r {path} && tail -n {lines} {path}" \
+               "".format(path=shlex_quote(path), lines=int(lines))
+    output, status = _bash_status(enode, tail_cmd, shell=shell)
+    assert status == 0, "Unable to read remote file {}".format(path)
+    return iter(output.splitlines())
+
+
+def grep_remote(enode, path, pattern, fixed=False, ignore_case=False,
+                max_count=None, shell='bash'):
+    """
+    Searches a pattern on a remote file with grep
+
+    Only the matching lines cross the shell.
+
+    :param str path: Path of the file on the enode.
+    :param str pattern: Regular expression (or string when fixed is set)
+    to search for.
+    :param bool fixed: -F: Interpret the pattern as a fixed string;
+    Default: False.
+    :param bool ignore_case: -i: Ignore case distinctions; Default: False.
+    :param int max_count: -m: Stop after this many matching lines.
+    :returns: Iterator over the matching lines.
+    :rtype: iterator of str.
+    """
+    options = ''
+    if fixed:
+        options = '{0}-F '.format(options)
+    if ignore_case:
+        options = '{0}-i '.format(options)
+    if max_count is not None:
+        options = '{0}-m {1} '.format(options, int(max_count))
+    grep_cmd = "grep {options}-e {pattern} -- {path}".format(
+        options=options, pattern=shlex_quote(pattern),
+        path=shlex_quote(path))
+    output, status = _bash_status(enode, grep_cmd, shell=shell)
+    # grep exits with 1 when nothing matches and 2 on errors
+    assert status in (0, 1), "Unable to grep remote file {}".format(path)
+    return iter(output.splitlines())
+
+
+def _parse_checksums(output, algo):
+    """
+    Parses the output of a *sum tool
+
+    :returns: The hex digest of every file in the output.
+    :rtype: dict of str to str.
+    """
+    checksum_line = re.compile(
+        r'^(\\?)([0-9a-fA-F]{%d}) [ *](.*)$' % _CHECKSUM_LENGTHS[algo]
+    )
+    digests = {}
+    for line in output.splitlines():
+        match = checksum_line.match(line.rstrip('\r'))
+        if match is None:
+            continue
+        escaped, digest, path = match.groups()
+        if escaped:
+            # Names with newlines or backslashes are escaped by the tool
+            path = re.sub(r'\\(.)',
+                          lambda m: '\n' if m.group(1) == 'n' else m.group(1),
+                          path)
+        digests[path] = digest.lower()
+    return digests
+
+
+def checksum_many(enode, paths, algo='sha256', max_cmd_len=_MAX_CMD_LEN,
+                  shell='bash'):
+    """
+    Calculates the checksum of several remote files
+
+    All the paths are checksummed with a single invocation of the *sum
+    tool (e.g. sha256sum), split in several commands only when the paths
+    do not fit in max_cmd_len. Nodes without the tool fall back to
+    Python's hashlib.
+
+    :param list paths: Paths of the files on the enode.
+    :param str algo: Hash algorithm. Options: md5|sha1|sha224|sha256|
+    sha384|sha512; Default: sha256.
+    :param int max_cmd_len: Maximum length of every command sent.
+    :returns: The hex digest of every file and the list of paths that do
+    not exist or could not be read.
+    :rtype: tuple of (dict of str to str, list).
+    """
+    assert algo in _CHECKSUM_LENGTHS, "unsupported algorithm {}".format(algo)
+    template = (
+        'if command -v {algo}sum >/dev/null 2>&1; then'
+        ' {algo}sum {paths} 2>/dev/null; else'
+        ' $(command -v python3 || command -v python) -c {script}'
+        ' {algo} {paths}; fi'
+    )
+    overhead = len(template.format(algo=algo, paths='',
+                                   script=shlex_quote(_CHECKSUM_SCRIPT)))
+
+    batches = [[]]
+    batch_len = overhead
+    for path in paths:
+        quoted = shlex_quote(path)
+        # Paths are included twice, one for each branch of the command
+        if batches[-1] and batch_len + 2 * (len(quoted) + 1) > max_cmd_len:
+            batches.append([])
+            batch_len = overhead
+        batches[-1].append(quoted)
+        batch_len += 2 * (len(quoted) + 1)
+
+    digests = {}
+    for batch in batches:
+        if not batch:
+            continue
+        checksum_cmd = template.format(
+            algo=algo, paths=' '.join(batch),
+            script=shlex_quote(_CHECKSUM_SCRIPT)
+        )
+        digests.update(_parse_checksums(enode(checksum_cmd, shell=shell),
+                                        algo))
+
+    found = dict((path, digests[path]) for path in paths if path in digests)
+    missing = [path for path in paths if path not in digests]
+    return found, missing
+
+
+def checksum_local(paths, algo='sha256', workers=4):
+    """
+    Calculates the checksum of several local files in parallel
+
+    This is the local counterpart of checksum_many, so a local tree can be
+    compared with the files deployed on a node.
+
+    :param list paths: Paths of the local files.
+    :param str algo: Name of a hashlib algorithm; Default: sha256.
+    :param int workers: Number of files hashed concurrently.
+    :returns: The hex digest of every file and the list of paths that do
+    not exist or could not be read.
+    :rtype: tuple of (dict of str to str, list).
+    """
+    def digest(path):
+        try:
+            return _hash_file(path, algo)
+        except (IOError, OSError):
+            return None
+
+    paths = list(paths)
+    results = _thread_map(digest, paths, workers)
+    found = dict((path, result) for path, result in zip(paths, results)
+                 if result is not None)
+    missing = [path for path, result in zip(paths, results)
+               if result is None]
+    return found, missing
+
+
+class RemoteFollower(object):
+    """
+    Follows growing files on an enode fetching only the appended bytes
+
+    The follower records the inode and the last byte offset of every
+    file. On each poll only the bytes appended since the previous poll are
+    transferred, and all the files are polled with a single command. When
+    a file is rotated (its inode changes or it shrinks) it is read again
+    from the start.
+
+    :param enode: Node where the files live.
+    :param paths: Paths of the files to follow.
+    :param bool from_start: Return the existing content of the files on
+    the first poll instead of only what is appended afterwards;
+    Default: False.
+    """
+
+    def __init__(self, enode, paths=(), from_start=False, shell='bash'):
+        self.enode = enode
+        self.from_start = from_start
+        self.shell = shell
+        # path -> (inode, offset); inode is None until the first poll and
+        # empty while the file does not exist
+        self.offsets = OrderedDict()
+        for path in paths:
+            self.add(path)
+
+    def add(self, path):
+        """
+        Starts following a file
+
+        :param str path: Path of the file on the enode.
+        """
+        if path not in self.offsets:
+            self.offsets[path] = (None, 0)
+
+    def remove(self, path):
+        """
+        Stops following a file
+
+        :param str path: Path of the file on the enode.
+        """
+        self.offsets.pop(path, None)
+
+    def _poll_cmd(self, index, path):
+        inode, offset = self.offsets[path]
+        if inode is None and not self.from_start:
+            reset = '$2'
+        else:
+            reset = '0'
+        return (
+            'if s=$(stat -c "%i %s" {path} 2>/dev/null); then set -- $s;'
+            ' o={offset}; if [ "$1" != "{inode}" ] || [ "$2" -lt $o ];'
+            ' then o={reset}; fi; echo "{marker} {index} $1 $2 $o";'
+            ' if [ "$2" -gt $o ]; then tail -c +$((o + 1)) {path}'
+            ' | head -c $(($2 - o)) | od -An -v -tx1; fi;'
+            ' else echo "{marker} {index} - - -"; fi'
+        ).format(path=shlex_quote(path), offset=offset, inode=inode or '',
+                 reset=reset, marker=_FOLLOW_MARKER, index=index)
+
+    def poll(self):
+        """
+        Fetches the bytes appended to every followed file
+
+        :returns: The new content of every file, empty when nothing was
+        appended or the file does not exist.
+        :rtype: OrderedDict of str to bytes.
+        """
+        paths = list(self.offsets)
+        if not paths:
+            return OrderedDict()
+        poll_cmd = '; '.join(self._poll_cmd(index, path)
+                             for index, path in enumerate(paths))
+        output = self.enode(poll_cmd, shell=self.shell)
+
+        encoded = OrderedDict((path, []) for path in paths)
+        current = None
+        for line in output.splitlines():
+            if line.startswith(_FOLLOW_MARKER):
+                index, inode, size, offset = line.split()[1:]
+                current = paths[int(index)]
+                if inode == '-':
+                    self.offsets[current] = ('', 0)
+                else:
+                    self.offsets[current] = (inode, int(size))
+            elif current is not None:
+                encoded[current].append(line)
+        assert current is not None, \
+            "Unable to poll remote files: {}".format(output)
+        return OrderedDict((path, _decode_od(' '.join(lines)))
+                           for path, lines in encoded.items())
+
+
+class RemoteEntry(namedtuple('RemoteEntry',
+                             ['path', 'type', 'size', 'mtime', 'mode'])):
+    """
+    Entry of a remote directory listing
+
+    The type is the find -printf %y letter (f for files, d for
+    directories, l for symbolic links...), the size is in bytes, the
+    mtime in seconds since the epoch and the mode holds the permission
+    bits.
+    """
+    __slots__ = ()
+
+
+class IndexDiff(namedtuple('IndexDiff', ['created', 'deleted', 'modified'])):
+    """
+    Differences between two RemoteIndex snapshots, as sorted lists of paths
+    """
+    __slots__ = ()
+
+
+def list_remote(enode, path, recursive=True, pattern=None, shell='bash'):
+    """
+    Lists a remote directory tree with metadata using find
+
+    All the entries are fetched with a single find -printf command. Entries
+    are NUL terminated remotely and translated for the console, so any
+    file name is supported. Directories that can not be read are skipped.
+
+    :param str path: Directory to list.
+    :param bool recursive: List the whole tree instead of only the direct
+    children of path; Default: True.
+    :param str pattern: Shell pattern the entry names must match, as in
+    find -name.
+    :returns: Generator with the entries below path.
+    :rtype: generator of RemoteEntry.
+    """
+    options = '-mindepth 1 '
+    if not recursive:
+        options = '{0}-maxdepth 1 '.format(options)
+    if pattern is not None:
+        options = '{0}-name {1} '.format(options, shlex_quote(pattern))
+    # Newlines in names become \001 and the NUL terminators newlines
+    list_cmd = "test -e {path} && find {path} {options}-printf " \
+               "'%y/%s/%T@/%m/%p\\0' 2>/dev/null | tr '\\n\\0' '\\001\\n'" \
+               "".format(path=shlex_quote(path), options=options)
+    output, status = _bash_status(enode, list_cmd, shell=shell)
+    assert status == 0, "Unable to list {}: {}".format(path, output)
+    entry_line = re.compile(
+        r'^([a-zA-Z])/(\d+)/(\d+(?:\.\d*)?)/([0-7]+)/(.+)$'
+    )
+    for line in output.splitlines():
+        # Anything else is console noise, e.g. messages from other processes
+        match = entry_line.match(line.rstrip('\r'))
+        if match is None:
+            continue
+        kind, size, mtime, mode, name = match.groups()
+        yield RemoteEntry(name.replace('\x01', '\n'), kind, int(size),
+                          float(mtime), int(mode, 8))
+
+
+class RemoteIndex(object):
+    """
+    In memory index of a remote directory listing
+
+    Supports fast lookups by path and diffing two snapshots, e.g. to
+    detect which files a test created:
+
+    ::
+
+        before = index_remote(enode, '/var/log')
+        ...
+        created = before.diff(index_remote(enode, '/var/log')).created
+
+    :param entries: Iterable of RemoteEntry.
+    """
+
+    def __init__(self, entries=()):
+        self.entries = dict((entry.path, entry) for entry in entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def __contains__(self, path):
+        return path in self.entries
+
+    def get(self, path, default=None):
+        """
+        Returns the entry of a path
+
+        :param str path: Path to look up.
+        :rtype: RemoteEntry.
+        """
+        return self.entries.get(path, default)
+
+    def diff(self, other):
+        """
+        Compares this snapshot with a newer one
+
+        :param RemoteIndex other: The newer snapshot.
+        :returns: The paths created, deleted and modified (type, size,
+        mtime or mode changed) in other.
+        :rtype: IndexDiff.
+        """
+        created = sorted(path for path in other.entries
+                         if path not in self.entries)
+        deleted = sorted(path for path in self.entries
+                         if path not in other.entries)
+        modified = sorted(path for path, entry in self.entries.items()
+                          if path in other.entries and
+                          other.entries[path] != entry)
+        return IndexDiff(created, deleted, modified)
+
+
+def index_remote(enode, path, recursive=True, pattern=None, shell='bash'):
+    """
+    Builds a RemoteIndex of a remote directory tree
+
+    See list_remote for the parameters.
+
+    :rtype: RemoteIndex.
+    """
+    return RemoteIndex(list_remote(enode, path, recursive=recursive,
+                                   pattern=pattern, shell=shell))
+
+
+def _printf_escape(data):
+    """
+    Escapes bytes to be written by printf '%b' inside single quotes
+
+    Printable characters are kept as they are, so text stays compact,
+    everything else is written as an octal escape.
+
+    :param bytes data: Content to escape.
+    :rtype: str.
+    """
+    escaped = []
+    for byte in bytearray(data):
+        if byte == 0x0a:
+            escaped.append('\\n')
+        elif 0x20 <= byte < 0x7f and byte not in (0x27, 0x5c):
+            escaped.append(chr(byte))
+        else:
+            escaped.append('\\0{:03o}'.format(byte))
+    return ''.join(escaped)
+
+
+def _printf_write(enode, chunks, remote_file, chunk_size=2048,
+                  shell='bash'):
+    """
+    Writes a stream of bytes chunks to a remote file with printf
+
+    :param chunks: Iterable with the content to write.
+    :param str remote_file: Shell quoted path of the file on the enode.
+    :param int chunk_size: Number of bytes written on every command.
+    """
+    output, status = _bash_status(enode, ': > {}'.format(remote_file),
+                                  shell=shell)
+    assert status == 0, "Unable to write {}: {}".format(remote_file, output)
+    for chunk in _iter_rechunked(chunks, chunk_size):
+        output, status = _bash_status(
+            enode, "printf '%b' '{}' >> {}".format(_printf_escape(chunk),
+                                                   remote_file),
+            shell=shell)
+        assert status == 0, "Unable to write {}: {}".format(remote_file,
+                                                            output)
+
+
+class StepResult(namedtuple('StepResult',
+                            ['name', 'status', 'output', 'value'])):
+    """
+    Result of a step of a FilePlan
+
+    The status is None when the step was skipped because a previous step
+    failed, value holds what the equivalent library function returns.
+    """
+    __slots__ = ()
+
+
+class FilePlan(object):
+    """
+    Batch of file operations executed in a single remote round trip
+
+    Operations are queued with methods named like the library functions,
+    compiled into one shell command with markers around every step, and
+    parsed back into a StepResult per step. The assertions of the library
+    functions are checked on those results after the execution.
+
+    ::
+
+        plan = FilePlan()
+        plan.create_filebkup('/etc/config')
+        plan.rm_command('/tmp/old', r=True)
+        plan.transfer_file('config', 'http://server/config')
+        plan.exists('/tmp/config')
+        results = plan.execute(enode)
+
+    :param bool stop_on_error: Skip the remaining steps on the node after
+    a step that must succeed fails; Default: True.
+    """
+
+    def __init__(self, stop_on_error=True):
+        self.stop_on_error = stop_on_error
+        self.steps = []
+
+    def add(self, name, cmd, check=None, critical=True):
+        """
+        Queues a shell command
+
+        :param str name: Name of the step, used on the results.
+        :param str cmd: Shell command to run.
+        :param check: Callable that receives the StepResult, asserts its
+        post-conditions and returns the value of the step.
+        :param bool critical: Whether the step must exit with status 0
+        for the rest of the plan to run.
+        :returns: The plan, so calls can be chained.
+        """
+        self.steps.append((name, cmd, check, critical))
+        return self
+
+    def rm_command(self, file_to_rm, d=False, f=True, i=False, r=False,
+                   v=False):
+        """ Queues a rm_command, see rm_command for the parameters """
+        def check(result):
+            assert result.output == '', \
+                "Unable to remove {}: {}".format(file_to_rm, result.output)
+
+        return self.add('rm_command',
+                        _rm_cmd(file_to_rm, d=d, f=f, i=i, r=r, v=v), check)
+
+    def file_exists(self, file_name, path):
+        """ Queues a file_exists, see file_exists for the parameters """
+        def check(result):
+            assert file_name in result.output, 'file does not exists'
+
+        return self.add('file_exists', 'ls {}'.format(path), check)
+
+    def exists(self, file):
+        """ Queues an exists, see exists for the parameters """
+        def check(result):
+            return "stat: cannot stat" not in result.output
+
+        return self.add('exists', 'stat {}'.format(file), check,
+                        critical=False)
+
+    def create_filebkup(self, destn_file_path):
+        """ Queues a create_filebkup, see create_filebkup """
+        assert len(destn_file_path) > 0, "empty destination file path"
+
+        def check(result):
+            assert "No such file or directory" not in result.output, \
+                "destn file not exists"
+
+        backup_create_command = 'ls -l {0} && cp {0} {0}.bkup'.format(
+            destn_file_path)
+        return self.add('create_filebkup', backup_create_command, check)
+
+    def restore_filebkup(self, destn_file_path):
+        """ Queues a restore_filebkup, see restore_filebkup """
+        assert len(destn_file_path) > 0, "empty destination file path"
+
+        def check(result):
+            assert "No such file or directory" not in result.output, \
+                "dest file not exists"
+
+        backup_restore_command = \
+            'ls -l {0}.bkup && cp {0}.bkup {0} && rm -f {0}.bkup'.format(
+                destn_file_path)
+        return self.add('restore_filebkup', backup_restore_command, check)
+
+    def transfer_file(self, name, file_orig, dst_path="/tmp",
+                      chunk_size=4096):
+        """
+        Queues a transfer_file, see transfer_file for the parameters
+
+        The content is fetched when the step is queued and written with
+        printf, so it is embedded in the command sent to the node. Files
+        whose escaped content exceeds _MAX_CMD_LEN are refused, use
+        transfer_file for them.
+        """
+        remote_file = shlex_quote("{dst_path}/{name}".format(**locals()))
+        writes = [': > {}'.format(remote_file)]
+        length = len(writes[0])
+        for chunk in _iter_file_chunks(file_orig, chunk_size=chunk_size):
+            writes.append("printf '%b' '{}' >> {}".format(
+                _printf_escape(chunk), remote_file))
+            length += len(writes[-1]) + 4
+            assert length <= _MAX_CMD_LEN, \
+                "{} is too big for a plan, use transfer_file".format(
+                    file_orig)
+
+        def check(result):
+            assert result.status == 0, \
+                "Unable to transfer {}: {}".format(file_orig, result.output)
+
+        return self.add('transfer_file', ' && '.join(writes), check)
+
+    def compile(self):
+        """
+        Builds the shell command that runs every step
+
+        :rtype: str.
+        """
+        commands = ['_fm_ok=1']
+        for index, (name, cmd, check, critical) in enumerate(self.steps):
+            step_cmd = '{{ {cmd} ; }} 2>&1; _fm_rc=$?'.format(cmd=cmd)
+            if critical and self.stop_on_error:
+                step_cmd = '{} ; [ $_fm_rc -eq 0 ] || _fm_ok=0'.format(
+                    step_cmd)
+            commands.append(
+                'if [ $_fm_ok -eq 1 ]; then echo "{marker} {index}"; {cmd}'
+                ' ; echo "{marker}_END {index} $_fm_rc"; else'
+                ' echo "{marker} {index}"; echo "{marker}_END {index} -";'
+                ' fi'.format(marker=_STEP_MARKER, index=index, cmd=step_cmd)
+            )
+        return '; '.join(commands)
+
+    def parse(self, output):
+        """
+        Splits the output of the compiled command in a result per step
+
+        :param str output: Output of the compiled command.
+        :rtype: list of StepResult.
+        """
+        step_output = re.compile(
+            r'{0} (\d+)\r?\n(.*?)\r?\n?{0}_END \1 (\d+|-)'.format(
+                _STEP_MARKER),
+            re.S
+        )
+        results = [None] * len(self.steps)
+        for match in step_output.finditer(output):
+            index, text, status = match.groups()
+            name = self.steps[int(index)][0]
+            status = None if status == '-' else int(status)
+            results[int(index)] = StepResult(name, status, text, None)
+        assert None not in results, \
+            "Unable to parse plan output: {}".format(output)
+        return results
+
+    def execute(self, enode, shell='bash'):
+        """
+        Runs every step on the enode with a single command
+
+        The post-conditions of every step are checked in order once the
+        results are parsed, raising on the first one that is not met.
+        Critical steps must also exit with status 0, and skipped steps are
+        reported naming the step that made the plan stop.
+
+        :rtype: list of StepResult.
+        """
+        if not self.steps:
+            return []
+        results = self.parse(enode(self.compile(), shell=shell))
+        failed = None
+        for index, result in enumerate(results):
+            name, cmd, check, critical = self.steps[index]
+            assert result.status is not None, \
+                "Step {} {} skipped because step {} failed".format(
+                    index, name, failed)
+            if check is not None:
+                results[index] = result._replace(value=check(result))
+            if critical and result.status != 0:
+                failed = '{} {}'.format(index, name)
+                assert False, "Step {} failed: {}".format(failed,
+                                                          result.output)
+        return results
+
+
+def copy_between(src_enode, src_path, dst_enode, dst_path, dst_ip=None,
+                 dst_user=None, dst_pass=None, chunk_size=65536,
+                 shell='bash', **kwargs):
+    """
+    Copies a file from a node to another without staging it on the host
+
+    When dst_ip is given the file is copied with scp from the source node
+    to the destination node. Otherwise, or when scp fails, the file is
+    relayed: chunks read from the source are written to the destination
+    as they arrive, so the file is never fully buffered on the host.
+    In both cases the sha256 of both copies is compared at the end.
+
+    :param src_enode: Node that holds the file.
+    :param str src_path: Path of the file on src_enode.
+    :param dst_enode: Node where the file is copied.
+    :param str dst_path: Path of the copy on dst_enode.
+    :param str dst_ip: IP address of dst_enode reachable from src_enode.
+    :param str dst_user: User of dst_enode used by scp.
+    :param str dst_pass: Password of dst_user, see scp_many.
+    :param int chunk_size: Number of bytes read from the source on every
+    command when relaying.
+    :param kwargs: Extra scp options, see scp_many.
+    :returns: The sha256 hex digest of the file.
+    :rtype: str.
+    """
+    digests, missing = checksum_many(src_enode, [src_path], shell=shell)
+    assert not missing, "source file doesn't exists: {}".format(src_path)
+    digest = digests[src_path]
+
+    if src_enode is dst_enode:
+        output, status = _bash_status(
+            src_enode, 'cp {} {}'.format(shlex_quote(src_path),
+                                         shlex_quote(dst_path)),
+            shell=shell)
+        assert status == 0, "Unable to copy {}: {}".format(src_path, output)
+        copied = True
+    elif dst_ip is not None:
+        result = scp_many(src_enode, [(src_path, dst_path, dst_ip)],
+                          remote_user=dst_user, remote_pass=dst_pass,
+                          shell=shell, **kwargs)[0]
+        copied = result.status == 0
+    else:
+        copied = False
+
+    if not copied:
+        relayed = hashlib.sha256()
+
+        def relay():
+            for chunk in read_remote(src_enode, src_path,
+                                     chunk_size=chunk_size, shell=shell):
+                relayed.update(chunk)
+                yield chunk
+
+        # Reading from the source overlaps with writing to the destination
+        _printf_write(dst_enode, _iter_background(relay()),
+                      shlex_quote(dst_path), shell=shell)
+        assert relayed.hexdigest() == digest, \
+            "{} changed while it was copied".format(src_path)
+
+    digests, missing = checksum_many(dst_enode, [dst_path], shell=shell)
+    assert digests.get(dst_path) == digest, \
+        "Checksum mismatch copying {} to {}".format(src_path, dst_path)
+    return digest
+
 
 __all__ = [
     'scp_command',
+    'scp_many',
+    'ScpResult',
     'rm_command',
     'sftp_get',
     'file_exists',
@@ -355,4 +1776,19 @@ __all__ = [
     'restore_filebkup',
     'exists',
     'transfer_file',
+    'read_remote',
+    'tail_remote',
+    'grep_remote',
+    'RemoteFollower',
+    'checksum_many',
+    'checksum_local',
+    'FilePlan',
+    'StepResult',
+    'TransferResult',
+    'list_remote',
+    'index_remote',
+    'RemoteEntry',
+    'RemoteIndex',
+    'IndexDiff',
+    'copy_between',
 ]
@@ -22,7 +22,144 @@ Test suite for module topology_lib_files_management.
 from __future__ import unicode_literals, absolute_import
 from __future__ import print_function, division
 
-# Add your test cases here.
+import os
+import hashlib
+import threading
+import subprocess
+
+import pytest
+from six.moves import BaseHTTPServer, socketserver
+
+from topology_lib_files_management import library
+from topology_lib_files_management.library import (
+    read_remote, tail_remote, grep_remote, RemoteFollower, checksum_many,
+    checksum_local, FilePlan, echo_filecopy, list_remote, index_remote,
+    scp_many, copy_between, transfer_file
+)
+
+
+class LocalNode(object):
+    """
+    Minimal enode that runs the bash commands on the local machine.
+    """
+
+    def __init__(self):
+        self.commands = []
+
+    def __call__(self, cmd, shell='bash'):
+        self.commands.append(cmd)
+        process = subprocess.Popen(
+            ['bash', '-c', cmd], stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT
+        )
+        output = process.communicate()[0].decode('utf-8')
+        return output.rstrip('\n')
+
+
+class PythonShell(object):
+    """
+    Fake bash shell that runs the remote Python REPL lines locally.
+    """
+
+    def __init__(self):
+        self.namespace = {}
+        self.response = ''
+        self.in_python = False
+
+    def send_command(self, cmd, matches=None, timeout=None):
+        if not self.in_python:
+            assert cmd == 'python'
+            self.in_python = True
+            return
+        if cmd == 'exit()':
+            self.in_python = False
+            return
+        try:
+            exec(cmd, self.namespace)
+            self.response = ''
+        except Exception as e:
+            self.response = 'Traceback\n{}: {}'.format(type(e).__name__, e)
+
+    def get_response(self):
+        return self.response
+
+
+class PythonNode(object):
+    """
+    Fake enode whose bash shell only supports the Python REPL.
+    """
+
+    def __init__(self):
+        self.shell = PythonShell()
+
+    def get_shell(self, name):
+        return self.shell
+
+
+class FileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the data of the server, honoring byte ranges when enabled.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        if self.server.head_status != 200:
+            self.send_response(self.server.head_status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        if self.server.accept_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(self.server.data)))
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+
+    def do_GET(self):
+        data = self.server.data
+        requested = self.headers.get('Range')
+        if requested and self.server.accept_ranges:
+            start, end = [int(limit) for limit in
+                          requested.split('=')[1].split('-')]
+            self.server.ranges.append((start, end))
+            body = data[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, end, len(data)))
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FileServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server for a single file.
+    """
+    daemon_threads = True
+
+
+@pytest.fixture
+def http_server():
+    """
+    Local HTTP server serving random data with byte ranges enabled.
+    """
+    server = FileServer(('127.0.0.1', 0), FileHandler)
+    server.data = os.urandom(10000)
+    server.accept_ranges = True
+    server.head_status = 200
+    server.ranges = []
+    server.url = 'http://127.0.0.1:{}/file'.format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
 
 
 def test_your_test_case():
@@ -30,3 +167,436 @@ def test_your_test_case():
     Document your test case here.
     """
     pass
+
+
+def test_read_remote(tmpdir):
+    """
+    Check that byte windows of a remote file are read back exactly.
+    """
+    content = bytes(bytearray(range(256))) * 10
+    remote = tmpdir.join('data.bin')
+    remote.write_binary(content)
+    enode = LocalNode()
+
+    assert b''.join(read_remote(enode, str(remote))) == content
+    window = read_remote(enode, str(remote), offset=100, length=1000,
+                         chunk_size=300)
+    chunks = list(window)
+    assert [len(chunk) for chunk in chunks] == [300, 300, 300, 100]
+    assert b''.join(chunks) == content[100:1100]
+    assert list(read_remote(enode, str(remote), offset=len(content))) == []
+
+
+def test_tail_and_grep_remote(tmpdir):
+    """
+    Check that tail and grep return only the requested lines.
+    """
+    remote = tmpdir.join('log.txt')
+    remote.write('\n'.join('line {}'.format(i) for i in range(100)) + '\n')
+    enode = LocalNode()
+
+    assert list(tail_remote(enode, str(remote), lines=2)) == [
+        'line 98', 'line 99'
+    ]
+    assert list(grep_remote(enode, str(remote), 'line 5.$')) == [
+        'line 50', 'line 51', 'line 52', 'line 53', 'line 54', 'line 55',
+        'line 56', 'line 57', 'line 58', 'line 59'
+    ]
+    assert list(grep_remote(enode, str(remote), 'missing')) == []
+
+    # Errors are reported when called, not when the lines are iterated
+    with pytest.raises(AssertionError):
+        tail_remote(enode, str(tmpdir.join('missing.txt')))
+    with pytest.raises(AssertionError):
+        grep_remote(enode, str(tmpdir.join('missing.txt')), 'line')
+
+
+def test_remote_follower(tmpdir):
+    """
+    Check that only appended bytes are returned and rotations are handled.
+    """
+    first = tmpdir.join('first.log')
+    second = tmpdir.join('second.log')
+    first.write('old\n')
+    follower = RemoteFollower(LocalNode(), [str(first), str(second)])
+
+    assert list(follower.poll().values()) == [b'', b'']
+    first.write('new\n', mode='a')
+    second.write('created\n')
+    assert list(follower.poll().values()) == [b'new\n', b'created\n']
+    assert list(follower.poll().values()) == [b'', b'']
+
+    first.rename(tmpdir.join('first.log.1'))
+    first.write('rotated\n')
+    assert list(follower.poll().values()) == [b'rotated\n', b'']
+
+
+def test_checksum_many(tmpdir):
+    """
+    Check that remote and local checksums match and missing files are
+    reported separately.
+    """
+    paths = []
+    for index in range(20):
+        local = tmpdir.join('file {}.txt'.format(index))
+        local.write('content {}\n'.format(index) * index)
+        paths.append(str(local))
+    paths.append(str(tmpdir.join('missing.txt')))
+
+    remote, remote_missing = checksum_many(LocalNode(), paths,
+                                           max_cmd_len=1024)
+    local, local_missing = checksum_local(paths)
+    assert remote == local
+    assert len(remote) == 20
+    assert remote_missing == local_missing == paths[-1:]
+
+
+def test_file_plan(tmpdir):
+    """
+    Check that a plan runs every step in a single command.
+    """
+    config = tmpdir.join('config')
+    config.write('original\n')
+    old = tmpdir.join('old')
+    old.write('')
+    origin = tmpdir.join('origin.bin')
+    content = b'it\'s \\ 100% "binary"\n\x00\xff' * 100
+    origin.write_binary(content)
+    enode = LocalNode()
+
+    plan = FilePlan()
+    plan.create_filebkup(str(config))
+    plan.rm_command(str(old))
+    plan.transfer_file('copy.bin', str(origin), str(tmpdir), chunk_size=64)
+    plan.exists(str(tmpdir.join('copy.bin')))
+    plan.exists(str(old))
+    results = plan.execute(enode)
+
+    assert len(enode.commands) == 1
+    assert [result.status for result in results] == [0, 0, 0, 0, 1]
+    assert [result.value for result in results[3:]] == [True, False]
+    assert tmpdir.join('config.bkup').read() == 'original\n'
+    assert tmpdir.join('copy.bin').read_binary() == content
+
+    keep = tmpdir.join('keep')
+    keep.write('')
+    plan = FilePlan()
+    plan.create_filebkup(str(tmpdir.mkdir('adir')))
+    plan.rm_command(str(keep))
+    plan.exists(str(keep))
+    with pytest.raises(AssertionError) as error:
+        plan.execute(enode)
+    assert 'create_filebkup' in str(error.value)
+    assert keep.check()
+
+    big = tmpdir.join('big.bin')
+    big.write_binary(os.urandom(20000))
+    with pytest.raises(AssertionError):
+        FilePlan().transfer_file('big.bin', str(big), str(tmpdir))
+
+    plan = FilePlan()
+    plan.restore_filebkup(str(tmpdir.join('missing')))
+    plan.rm_command(str(config))
+    with pytest.raises(AssertionError):
+        plan.execute(enode)
+    assert config.check()
+
+
+def test_echo_filecopy_codec(tmpdir):
+    """
+    Check that compression is only used when the payload compresses.
+    """
+    enode = LocalNode()
+    text = tmpdir.join('text.cfg')
+    text.write('interface 1/1/1\n    no shutdown\n' * 500)
+    noise = tmpdir.join('noise.bin')
+    noise.write_binary(os.urandom(4096))
+    destination = tmpdir.join('destination')
+
+    result = echo_filecopy(enode, str(text), str(destination), codec='auto')
+    assert result.codec != 'none'
+    assert result.ratio > 5
+    assert destination.read() == text.read()
+
+    result = echo_filecopy(enode, str(noise), str(destination), codec='auto')
+    assert result.codec == 'none'
+    assert result.sent == result.size == 4096
+    assert destination.read_binary() == noise.read_binary()
+
+    result = echo_filecopy(enode, str(text), str(destination))
+    assert result.codec == 'none'
+    assert result.sent == result.size == text.size()
+
+
+def test_list_remote(tmpdir):
+    """
+    Check the parsing of remote listings and the diff of two snapshots.
+    """
+    enode = LocalNode()
+    tmpdir.join('sub').mkdir()
+    tmpdir.join('sub', 'nested.log').write('12345')
+    tmpdir.join('odd_name\nwith newline.txt').write('')
+    tmpdir.join('keep.txt').write('keep')
+
+    entries = dict((entry.path, entry)
+                   for entry in list_remote(enode, str(tmpdir)))
+    nested = entries[str(tmpdir.join('sub', 'nested.log'))]
+    assert (nested.type, nested.size) == ('f', 5)
+    assert entries[str(tmpdir.join('sub'))].type == 'd'
+    assert str(tmpdir.join('odd_name\nwith newline.txt')) in entries
+    assert len(entries) == 4
+    assert len(list(list_remote(enode, str(tmpdir), recursive=False))) == 3
+    assert [entry.path for entry in list_remote(enode, str(tmpdir),
+                                                pattern='*.log')] == [
+        str(tmpdir.join('sub', 'nested.log'))
+    ]
+
+    before = index_remote(enode, str(tmpdir))
+    tmpdir.join('created.txt').write('')
+    tmpdir.join('keep.txt').write('changed')
+    tmpdir.join('sub', 'nested.log').remove()
+    changes = before.diff(index_remote(enode, str(tmpdir)))
+    assert changes.created == [str(tmpdir.join('created.txt'))]
+    assert changes.deleted == [str(tmpdir.join('sub', 'nested.log'))]
+    assert str(tmpdir.join('keep.txt')) in changes.modified
+
+
+def test_scp_many(tmpdir):
+    """
+    Check that every job gets its own status, also on merged invocations.
+    """
+    enode = LocalNode()
+    destination = tmpdir.mkdir('destination')
+    origins = []
+    for index in range(5):
+        origin = tmpdir.join('origin{}.txt'.format(index))
+        origin.write(str(index))
+        origins.append(str(origin))
+    jobs = [(origin, str(destination) + '/') for origin in origins]
+    jobs.append((str(tmpdir.join('missing.txt')), str(destination) + '/'))
+    jobs.append((origins[0], str(destination.join('renamed.txt'))))
+
+    results = scp_many(enode, jobs, port=22)
+    assert len(enode.commands) == 1
+    assert [result.status == 0 for result in results] == [
+        True, True, True, True, True, False, True
+    ]
+    assert destination.join('origin4.txt').read() == '4'
+    assert destination.join('renamed.txt').read() == '0'
+
+
+def test_copy_between(tmpdir):
+    """
+    Check the relay of a file between two nodes without scp.
+    """
+    source_node = LocalNode()
+    destination_node = LocalNode()
+    source = tmpdir.join('source.bin')
+    content = os.urandom(20000) + b"quotes ' and \\ backslashes\n"
+    source.write_binary(content)
+    destination = tmpdir.join('destination.bin')
+
+    digest = copy_between(source_node, str(source), destination_node,
+                          str(destination), chunk_size=4096)
+    assert destination.read_binary() == content
+    assert digest == hashlib.sha256(content).hexdigest()
+    assert len(source_node.commands) > 5
+
+    with pytest.raises(AssertionError):
+        copy_between(source_node, str(tmpdir.join('missing')),
+                     destination_node, str(destination))
+
+
+def test_download_ranges(http_server, monkeypatch):
+    """
+    Check that servers with byte ranges are downloaded in parallel ranges.
+    """
+    monkeypatch.setattr(library, '_RANGE_MIN_SIZE', 1024)
+    checksum = hashlib.sha256(http_server.data).hexdigest()
+
+    chunks = library._iter_file_chunks(http_server.url, chunk_size=1000,
+                                       connections=4, checksum=checksum)
+    assert b''.join(chunks) == http_server.data
+    assert sorted(http_server.ranges) == [
+        (0, 2499), (2500, 4999), (5000, 7499), (7500, 9999)
+    ]
+
+    with pytest.raises(AssertionError):
+        b''.join(library._iter_file_chunks(http_server.url, connections=4,
+                                           checksum='0' * 64))
+
+
+def test_download_ranges_in_order(http_server, monkeypatch):
+    """
+    Check that small ranges are fetched in order and yielded as they
+    complete.
+    """
+    monkeypatch.setattr(library, '_RANGE_MIN_SIZE', 1024)
+    monkeypatch.setattr(library, '_RANGE_SIZE', 1000)
+
+    chunks = library._iter_file_chunks(http_server.url, chunk_size=4096,
+                                       connections=3)
+    first = next(chunks)
+    assert first == http_server.data[:1000]
+    assert first + b''.join(chunks) == http_server.data
+    assert sorted(http_server.ranges) == [
+        (start, start + 999) for start in range(0, 10000, 1000)
+    ]
+
+
+@pytest.mark.parametrize('accept_ranges, head_status', [
+    (False, 200), (True, 405)
+])
+def test_download_single_stream(http_server, monkeypatch, accept_ranges,
+                                head_status):
+    """
+    Check the fallback to a single stream without usable byte ranges.
+    """
+    monkeypatch.setattr(library, '_RANGE_MIN_SIZE', 1024)
+    http_server.accept_ranges = accept_ranges
+    http_server.head_status = head_status
+
+    chunks = library._iter_file_chunks(http_server.url, connections=4)
+    assert b''.join(chunks) == http_server.data
+    assert http_server.ranges == []
+
+
+def test_thread_map():
+    """
+    Check that results keep their order and errors reach the caller.
+    """
+    assert library._thread_map(lambda item: item * 2, range(10), 3) == [
+        item * 2 for item in range(10)
+    ]
+
+    def fail(item):
+        if item == 5:
+            raise ValueError(item)
+        return item
+
+    with pytest.raises(ValueError):
+        library._thread_map(fail, range(10), 3)
+
+
+@pytest.mark.parametrize('codec', ['none', 'zlib', 'gzip', 'xz', 'auto'])
+def test_transfer_file(tmpdir, codec):
+    """
+    Check that the remote file matches the origin for every codec.
+    """
+    if codec == 'xz' and library.lzma is None:
+        pytest.skip('lzma is not available')
+    origin = tmpdir.join('origin.cfg')
+    content = b'hostname switch\n' * 2000 + os.urandom(3000) + b"'\\"
+    origin.write_binary(content)
+    enode = PythonNode()
+
+    result = transfer_file(enode, 'copy.cfg', str(origin),
+                           dst_path=str(tmpdir), codec=codec,
+                           chunk_size=1000)
+    assert tmpdir.join('copy.cfg').read_binary() == content
+    assert result.path == str(tmpdir.join('copy.cfg'))
+    assert result.size == len(content)
+    if codec == 'none':
+        assert result.sent == result.size
+    else:
+        assert result.codec != 'none'
+        assert result.sent < result.size
+    assert not enode.shell.in_python
+
+
+def test_transfer_file_ranges(http_server, tmpdir, monkeypatch):
+    """
+    Check a transfer from a HTTP server with ranges and a checksum.
+    """
+    monkeypatch.setattr(library, '_RANGE_MIN_SIZE', 1024)
+    checksum = hashlib.sha256(http_server.data).hexdigest()
+    enode = PythonNode()
+
+    transfer_file(enode, 'copy.bin', http_server.url, dst_path=str(tmpdir),
+                  connections=4, checksum=checksum)
+    assert tmpdir.join('copy.bin').read_binary() == http_server.data
+    assert http_server.ranges
+
+    with pytest.raises(AssertionError):
+        transfer_file(enode, 'copy.bin', http_server.url,
+                      dst_path=str(tmpdir), checksum='0' * 64)
+    assert not enode.shell.in_python
+
+
+def test_iter_rechunked():
+    """
+    Check that chunks are regrouped in blocks of the requested size.
+    """
+    chunks = [b'ab', b'', b'cdefg', b'h', b'ijklmnopq']
+    assert list(library._iter_rechunked(chunks, 4)) == [
+        b'abcd', b'efgh', b'ijkl', b'mnop', b'q'
+    ]
+    assert list(library._iter_rechunked([], 4)) == []
+
+
+def test_iter_background():
+    """
+    Check that items and errors go through and early stops close the
+    producer.
+    """
+    assert list(library._iter_background(iter(range(100)), depth=2)) == \
+        list(range(100))
+
+    def failing():
+        yield 1
+        raise ValueError('producer failed')
+
+    with pytest.raises(ValueError):
+        list(library._iter_background(failing()))
+
+    closed = threading.Event()
+
+    def endless():
+        try:
+            while True:
+                yield b'chunk'
+        finally:
+            closed.set()
+
+    items = library._iter_background(endless(), depth=2)
+    assert next(items) == b'chunk'
+    items.close()
+    assert closed.wait(5)
+
+
+class NoisyNode(LocalNode):
+    """
+    LocalNode that mixes a find error in the output, as a console does.
+    """
+
+    def __call__(self, cmd, shell='bash'):
+        output = super(NoisyNode, self).__call__(cmd, shell=shell)
+        return "find: '/var/log/private/x/y': Permission denied\n" + output
+
+
+def test_list_remote_errors(tmpdir):
+    """
+    Check that unreadable directories and console noise are skipped.
+    """
+    tmpdir.join('readable.txt').write('')
+    private = tmpdir.mkdir('private')
+    private.join('hidden.txt').write('')
+
+    entries = [entry.path for entry in list_remote(NoisyNode(), str(tmpdir))]
+    assert sorted(entries) == sorted([
+        str(private), str(private.join('hidden.txt')),
+        str(tmpdir.join('readable.txt'))
+    ])
+
+    if os.geteuid() == 0:
+        # Permissions do not apply to root
+        return
+    private.chmod(0)
+    try:
+        entries = [entry.path
+                   for entry in list_remote(LocalNode(), str(tmpdir))]
+    finally:
+        private.chmod(0o700)
+    assert sorted(entries) == sorted([
+        str(private), str(tmpdir.join('readable.txt'))
+    ])